@@ -1,13 +1,21 @@
 import os
+import atexit
 import io
-import json
 import base64
-import random
-import string
+import logging
+import secrets
+import threading
+import time
+import anyio
 import numpy as np
-import requests
-from typing import List, Dict, Optional
-from fastapi import FastAPI, Query
+import orjson
+import httpx
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from PIL import Image
@@ -25,11 +33,30 @@ os.makedirs(MASK_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
 
 TORCHSERVE_URL = "http://localhost:7779/predict"  # fixed
+IMAGE_CACHE_SIZE = 32  # images kept in memory for repeat clicks
+MASK_CACHE_SIZE = 256  # recent TorchServe results, keyed by image + points
+MASK_CACHE_TTL = 10.0  # seconds
+STATE_SNAPSHOT_EVERY = 200  # /log appends between processed-state snapshots
+
+logger = logging.getLogger(__name__)
 
 # -------------------------
 # App Setup
 # -------------------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # pooled keep-alive client for TorchServe calls
+    app.state.http = httpx.AsyncClient(
+        timeout=60,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+        close_logs()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],          # dev-friendly; tighten for production
@@ -67,11 +94,28 @@ class LogRequest(BaseModel):
     query_id: int
     action: str  # "done" or "skip"
 
+# Response models let FastAPI serialize straight to JSON bytes via Pydantic.
+class MaskResponse(BaseModel):
+    mask_png_b64: Optional[str] = None
+
+class SaveResponse(BaseModel):
+    status: str
+    mask_name: str
+
+class MasksResponse(BaseModel):
+    combined_thumb_png_b64: str
+
+class LogResponse(BaseModel):
+    status: str
+
+class StatusResponse(BaseModel):
+    processed: Dict[str, str]
+
 # -------------------------
 # Helpers
 # -------------------------
 def random_id(n: int = 10) -> str:
-    return "".join(random.choices(string.ascii_lowercase + string.digits, k=n))
+    return secrets.token_hex((n + 1) // 2)[:n]
 
 def mask_dir_for(image_name: str, query_id: int) -> str:
     base, _ = os.path.splitext(image_name)
@@ -79,108 +123,264 @@ def mask_dir_for(image_name: str, query_id: int) -> str:
     os.makedirs(mdir, exist_ok=True)
     return mdir
 
-def load_meta(mdir: str) -> list:
-    path = os.path.join(mdir, "mask_metadata.json")
+def load_mask(path: str) -> np.ndarray:
+    # .npz: bit-packed mask + shape, returned as bool; .npy: legacy uint8 mask
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            shape = tuple(int(d) for d in data["shape"])
+            bits = np.unpackbits(data["packed"], count=shape[0] * shape[1])
+        return bits.view(np.bool_).reshape(shape)  # bits are 0/1: free view
+    return np.load(path)
+
+# Parsed mask_metadata.json per mask dir as (st_mtime_ns, names); an entry
+# is reused while the file's mtime is unchanged (-1: file missing).
+_META_CACHE: Dict[str, Tuple[int, list]] = {}
+_META_LOCK = threading.RLock()
+
+def _meta_mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+def _read_meta(path: str) -> list:
     if os.path.exists(path):
         try:
-            with open(path, "r") as f:
-                return json.load(f)
+            with open(path, "rb") as f:
+                return orjson.loads(f.read())
         except Exception:
             return []
     return []
 
+def load_meta(mdir: str) -> list:
+    path = os.path.join(mdir, "mask_metadata.json")
+    mtime = _meta_mtime(path)
+    with _META_LOCK:
+        cached = _META_CACHE.get(mdir)
+        if cached is None or cached[0] != mtime:
+            cached = _META_CACHE[mdir] = (mtime, _read_meta(path))
+        return list(cached[1])
+
 def save_meta(mdir: str, names: list):
     path = os.path.join(mdir, "mask_metadata.json")
-    with open(path, "w") as f:
-        json.dump(names, f, indent=2)
+    with _META_LOCK:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(names, option=orjson.OPT_INDENT_2))
+        _META_CACHE[mdir] = (_meta_mtime(path), list(names))
 
 def update_metadata(mdir: str, mask_name: str):
-    names = load_meta(mdir)
-    if mask_name not in names:
-        names.append(mask_name)
-    save_meta(mdir, names)
-
-def call_torchserve(image_name: str, points: List[Dict]) -> Optional[str]:
+    with _META_LOCK:
+        names = load_meta(mdir)
+        if mask_name not in names:
+            names.append(mask_name)
+            save_meta(mdir, names)
+
+# ---- Image bytes cache (LRU, shared by /click and /preview) ----
+# Keyed by (image_name, mtime) so a replaced file is re-read, matching the
+# thumbnail caches. Only touched from the event loop, so no lock is needed.
+_IMAGE_CACHE: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+
+async def load_image_bytes(image_name: str) -> bytes:
+    # stat and read both run in worker threads, off the event loop
+    path = anyio.Path(IMAGES_DIR, image_name)
+    key = (image_name, (await path.stat()).st_mtime_ns)
+    cached = _IMAGE_CACHE.get(key)
+    if cached is not None:
+        _IMAGE_CACHE.move_to_end(key)
+        return cached
+
+    image_bytes = await path.read_bytes()
+
+    _IMAGE_CACHE[key] = image_bytes
+    while len(_IMAGE_CACHE) > IMAGE_CACHE_SIZE:
+        _IMAGE_CACHE.popitem(last=False)
+    return image_bytes
+
+async def call_torchserve(image_name: str, points: List[Point]) -> Optional[str]:
     try:
-        img_path = os.path.join(IMAGES_DIR, image_name)
-        with open(img_path, "rb") as f:
-            image_bytes = f.read()
+        image_bytes = await load_image_bytes(image_name)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="image not found")
 
-        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-        payload = {"image": image_b64, "points": points}
-        resp = requests.post(TORCHSERVE_URL, json=payload, timeout=60)
+    try:
+        points_json = orjson.dumps([{"x": p.x, "y": p.y, "label": p.label} for p in points])
+        # multipart: raw image bytes, no base64 inflation on the way out
+        resp = await app.state.http.post(
+            TORCHSERVE_URL,
+            files={"image": (image_name, image_bytes, "application/octet-stream")},
+            data={"points": points_json},
+        )
         resp.raise_for_status()
         return resp.json().get("mask_png_b64")
     except Exception as e:
-        print("TorchServe failed:", e)
-        return None
+        logger.exception("TorchServe call failed for %s: %s", image_name, e)
+        raise HTTPException(status_code=502, detail="TorchServe request failed")
+
+# ---- Short-lived mask cache: /preview and /click with the same points ----
+_MASK_CACHE: "OrderedDict[tuple, Tuple[float, str]]" = OrderedDict()
+
+async def predict_mask(image_name: str, points: List[Point]) -> Optional[str]:
+    key = (image_name, tuple((p.x, p.y, p.label) for p in points))
+    now = time.monotonic()
+    hit = _MASK_CACHE.pop(key, None)
+    if hit is not None and now - hit[0] < MASK_CACHE_TTL:
+        _MASK_CACHE[key] = hit
+        return hit[1]
+
+    mask_b64 = await call_torchserve(image_name, points)
+    if mask_b64 is not None:
+        _MASK_CACHE[key] = (now, mask_b64)
+        while len(_MASK_CACHE) > MASK_CACHE_SIZE:
+            _MASK_CACHE.popitem(last=False)
+    return mask_b64
 
 # ---- Combined thumbnail (each mask different color) ----
-def distinct_colors(n: int):
+@lru_cache(maxsize=128)
+def distinct_colors(n: int) -> Tuple[Tuple[int, int, int], ...]:
     if n <= 0:
-        return []
+        return ()
     hues = [i / n for i in range(n)]
-    return [
+    return tuple(
         tuple(int(c * 255) for c in colorsys.hsv_to_rgb(h, 0.8, 1.0))
         for h in hues
-    ]
+    )
+
+@lru_cache(maxsize=16)
+def _load_base_image(image_name: str, mtime: float, size: Tuple[int, int]) -> Image.Image:
+    # mtime is only part of the cache key, so an edited image is re-decoded
+    img = Image.open(os.path.join(IMAGES_DIR, image_name))
+    img.draft("RGB", size)  # JPEG: let libjpeg scale down while decoding
+    img = img.convert("RGB")
+    if img.size != size:
+        img = img.resize(size, Image.BILINEAR)
+    return img
+
+def load_base_image(image_name: str, size: Tuple[int, int]) -> Image.Image:
+    """Decoded RGB base image at `size`; shared, so callers must not mutate it."""
+    mtime = os.path.getmtime(os.path.join(IMAGES_DIR, image_name))
+    return _load_base_image(image_name, mtime, size)
+
+def _jpeg_b64(img: Image.Image) -> str:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=80)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
 
-def make_combined_thumbnail(image_name: str, mask_paths: List[str], thumb_w: int = 240) -> str:
-    img_path = os.path.join(IMAGES_DIR, image_name)
-    base_img = Image.open(img_path).convert("RGBA")
+@lru_cache(maxsize=16)
+def _base_thumbnail_b64(image_name: str, mtime: float, size: Tuple[int, int]) -> str:
+    return _jpeg_b64(_load_base_image(image_name, mtime, size))
 
-    masks: List[np.ndarray] = []
-    for p in mask_paths:
-        try:
-            masks.append(np.load(p))
-        except Exception:
-            pass
+def base_thumbnail_b64(image_name: str, size: Tuple[int, int]) -> str:
+    """Encoded thumbnail of the bare image, for mask sets with nothing to draw."""
+    mtime = os.path.getmtime(os.path.join(IMAGES_DIR, image_name))
+    return _base_thumbnail_b64(image_name, mtime, size)
+
+# np.load / zlib / unpackbits release the GIL, so masks load in parallel.
+_MASK_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+def _try_load_mask(path: str) -> Optional[np.ndarray]:
+    try:
+        return load_mask(path)
+    except Exception:
+        return None
+
+def make_combined_thumbnail(image_name: str, mask_paths: List[str], thumb_w: int = 240) -> str:
+    masks = [m for m in _MASK_POOL.map(_try_load_mask, mask_paths) if m is not None]
 
     if not masks:
         return ""
 
+    # Work at thumbnail resolution: shrink base and masks, then blend.
     h, w = masks[0].shape[:2]
-    if base_img.size != (w, h):
-        base_img = base_img.resize((w, h), Image.BILINEAR)
+    if w > thumb_w:
+        w, h = thumb_w, int(h * thumb_w / w)
 
-    colors = distinct_colors(len(masks))
-    overlay = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+    # All-empty masks (saved rejected predictions) leave the base unchanged.
+    drawn = [(i, m) for i, m in enumerate(masks) if m.any()]
+    if not drawn:
+        return base_thumbnail_b64(image_name, (w, h))
 
-    for mask_np, color in zip(masks, colors):
-        alpha = Image.fromarray((mask_np > 0).astype(np.uint8) * 110, mode="L")
-        color_img = Image.new("RGBA", (w, h), color + (0,))
-        color_img.putalpha(alpha)
-        overlay = Image.alpha_composite(overlay, color_img)
+    base_img = load_base_image(image_name, (w, h))
+    colors = distinct_colors(len(masks))
+    out = np.array(base_img)  # writable copy; the cached base stays untouched
+    a = 110
 
-    composed = Image.alpha_composite(base_img, overlay)
+    # Last mask covering each pixel (-1: none), so the blend below is a
+    # single pass over the frame; where masks overlap the later one wins.
+    owner = np.full((h, w), -1, np.int16)
+    for i, mask_np in drawn:
+        if mask_np.shape[:2] != (h, w):
+            mask_np = np.asarray(Image.fromarray(mask_np).resize((w, h), Image.NEAREST))
+        owner[mask_np if mask_np.dtype == np.bool_ else mask_np > 0] = i
 
-    if composed.width > thumb_w:
-        ratio = thumb_w / composed.width
-        composed = composed.resize((thumb_w, int(composed.height * ratio)), Image.BILINEAR)
+    hit = owner >= 0
+    tints = np.array(colors, np.uint16) * a
+    px = out[hit].astype(np.uint16)
+    out[hit] = ((px * (255 - a) + tints[owner[hit]] + 127) // 255).astype(np.uint8)
 
-    buf = io.BytesIO()
-    composed.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    return _jpeg_b64(Image.fromarray(out))
 
 # ---- Logging helpers ----
 def _log_path(chunk_id: int) -> str:
     return os.path.join(LOGS_DIR, f"chunk_{chunk_id}.jsonl")
 
+def _state_path(chunk_id: int) -> str:
+    return os.path.join(LOGS_DIR, f"chunk_{chunk_id}.state.json")
+
+# One O_APPEND descriptor per chunk, kept open for the life of the process.
+_LOG_FDS: Dict[int, int] = {}
+_LOG_LOCK = threading.Lock()
+
+# chunk_id -> {index: last action}; a chunk is loaded once (snapshot plus
+# the log lines written after it, or a full log scan), then kept current
+# by append_log.
+PROCESSED: Dict[int, Dict[int, str]] = {}
+# appends per chunk since its last snapshot
+_UNSNAPSHOTTED: Dict[int, int] = {}
+
+def _write_all(fd: int, data: bytes):
+    # os.write may write fewer bytes than asked; a failure mid-line raises
+    # before the caller records the entry as logged.
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
 def append_log(entry: dict):
-    path = _log_path(entry["chunk_id"])
+    chunk_id = entry["chunk_id"]
     entry = {**entry, "ts": datetime.utcnow().isoformat() + "Z"}
-    with open(path, "a") as f:
-        f.write(json.dumps(entry) + "\n")
-
-def load_processed(chunk_id: int) -> Dict[int, str]:
+    line = orjson.dumps(entry) + b"\n"
+    with _LOG_LOCK:
+        fd = _LOG_FDS.get(chunk_id)
+        if fd is None:
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+            fd = _LOG_FDS[chunk_id] = os.open(_log_path(chunk_id), flags, 0o644)
+        _write_all(fd, line)
+        _processed_for(chunk_id)[entry["index"]] = entry["action"]
+        _UNSNAPSHOTTED[chunk_id] = _UNSNAPSHOTTED.get(chunk_id, 0) + 1
+        if _UNSNAPSHOTTED[chunk_id] >= STATE_SNAPSHOT_EVERY:
+            _write_state(chunk_id)
+
+def close_logs():
+    with _LOG_LOCK:
+        for chunk_id in list(_UNSNAPSHOTTED):
+            _write_state(chunk_id)
+        for fd in _LOG_FDS.values():
+            os.close(fd)
+        _LOG_FDS.clear()
+
+atexit.register(close_logs)
+
+def load_processed(chunk_id: int, offset: int = 0,
+                   results: Optional[Dict[int, str]] = None) -> Dict[int, str]:
+    """Apply the chunk's log lines from byte `offset` on to `results`."""
     path = _log_path(chunk_id)
-    results: Dict[int, str] = {}
+    results = {} if results is None else results
     if not os.path.exists(path):
         return results
-    with open(path, "r") as f:
+    with open(path, "rb") as f:
+        f.seek(offset)
         for line in f:
             try:
-                obj = json.loads(line)
+                obj = orjson.loads(line)
             except Exception:
                 continue
             if obj.get("chunk_id") != chunk_id:
@@ -191,40 +391,93 @@ def load_processed(chunk_id: int) -> Dict[int, str]:
                 results[idx] = act
     return results
 
+def _write_state(chunk_id: int):
+    # caller holds _LOG_LOCK, so every logged line is already in PROCESSED
+    # and the log's current size is exactly what the snapshot covers
+    try:
+        offset = os.path.getsize(_log_path(chunk_id))
+    except OSError:
+        return
+    processed = PROCESSED.get(chunk_id, {})
+    state = {"offset": offset, "processed": {str(k): v for k, v in processed.items()}}
+    path = _state_path(chunk_id)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(state))
+    os.replace(tmp, path)  # readers never see a half-written snapshot
+    _UNSNAPSHOTTED.pop(chunk_id, None)
+
+def _load_state(chunk_id: int) -> Optional[Dict[int, str]]:
+    # Snapshot + replay of the log lines written after it. None when there
+    # is no usable snapshot, or the log is shorter than the snapshot says
+    # (truncated or replaced), so the caller falls back to a full scan.
+    try:
+        with open(_state_path(chunk_id), "rb") as f:
+            state = orjson.loads(f.read())
+        offset = int(state["offset"])
+        processed = {int(k): v for k, v in state["processed"].items()}
+        log_size = os.path.getsize(_log_path(chunk_id))
+    except Exception:
+        return None
+    if offset > log_size:
+        return None
+    return load_processed(chunk_id, offset, processed)
+
+def _processed_for(chunk_id: int) -> Dict[int, str]:
+    # caller holds _LOG_LOCK
+    processed = PROCESSED.get(chunk_id)
+    if processed is None:
+        processed = _load_state(chunk_id)
+        if processed is None:
+            processed = load_processed(chunk_id)
+        PROCESSED[chunk_id] = processed
+        if os.path.exists(_log_path(chunk_id)):
+            _UNSNAPSHOTTED.setdefault(chunk_id, 0)  # refresh snapshot on close
+    return processed
+
+def get_processed(chunk_id: int) -> Dict[int, str]:
+    with _LOG_LOCK:
+        return dict(_processed_for(chunk_id))
+
 # -------------------------
 # Endpoints
 # -------------------------
-@app.post("/click")
-def click(req: ClickRequest):
-    mask_b64 = call_torchserve(req.image_name, [p.dict() for p in req.points])
+@app.post("/click", response_model=MaskResponse)
+async def click(req: ClickRequest):
+    mask_b64 = await predict_mask(req.image_name, req.points)
     return {"mask_png_b64": mask_b64}
 
-@app.post("/preview")
-def preview(req: ClickRequest):
-    mask_b64 = call_torchserve(req.image_name, [p.dict() for p in req.points])
+@app.post("/preview", response_model=MaskResponse)
+async def preview(req: ClickRequest):
+    mask_b64 = await predict_mask(req.image_name, req.points)
+    if mask_b64 is None:
+        return Response(status_code=204)
     return {"mask_png_b64": mask_b64}
 
-@app.post("/save")
+@app.post("/save", response_model=SaveResponse)
 def save(req: SaveRequest):
     try:
         mask_bytes = base64.b64decode(req.mask_png_b64)
-        mask_img = Image.open(io.BytesIO(mask_bytes)).convert("L")
-        mask_np = np.array(mask_img)
-
-        mdir = mask_dir_for(req.image_name, req.query_id)
-        mask_name = f"{random_id(10)}.npy"
-        out_path = os.path.join(mdir, mask_name)
-        np.save(out_path, mask_np)
-
-        update_metadata(mdir, mask_name)
-        return {"status": "ok", "mask_name": mask_name}
-    except Exception as e:
-        return {"error": str(e)}
-
-@app.get("/masks")
+        mask_img = Image.open(io.BytesIO(mask_bytes))
+        if mask_img.mode not in ("1", "L"):
+            mask_img = mask_img.convert("L")
+        mask_np = np.asarray(mask_img)
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid mask PNG")
+
+    mdir = mask_dir_for(req.image_name, req.query_id)
+    mask_name = f"{random_id(10)}.npz"
+    out_path = os.path.join(mdir, mask_name)
+    np.savez_compressed(out_path, packed=np.packbits(mask_np > 0), shape=mask_np.shape)
+
+    update_metadata(mdir, mask_name)
+    return {"status": "ok", "mask_name": mask_name}
+
+@app.get("/masks", response_model=MasksResponse)
 def list_masks(image_name: str = Query(...), query_id: int = Query(...)):
     """
-    Return only the combined thumbnail.
+    Return only the combined thumbnail (JPEG bytes; the key keeps its
+    historical _png_ name).
     """
     mdir = mask_dir_for(image_name, query_id)
     names = load_meta(mdir)
@@ -233,10 +486,10 @@ def list_masks(image_name: str = Query(...), query_id: int = Query(...)):
     return {"combined_thumb_png_b64": combined_b64}
 
 # ---- Logging endpoints ----
-@app.post("/log")
+@app.post("/log", response_model=LogResponse)
 def log_action(req: LogRequest):
     if req.action not in {"done", "skip"}:
-        return {"error": "action must be 'done' or 'skip'"}
+        raise HTTPException(status_code=400, detail="action must be 'done' or 'skip'")
     append_log({
         "chunk_id": req.chunk_id,
         "index": req.index,
@@ -246,7 +499,7 @@ def log_action(req: LogRequest):
     })
     return {"status": "ok"}
 
-@app.get("/status")
+@app.get("/status", response_model=StatusResponse)
 def get_status(chunk_id: int = Query(...)):
-    processed = load_processed(chunk_id)
+    processed = get_processed(chunk_id)
     return {"processed": {str(k): v for k, v in processed.items()}}
@@ -454,7 +454,7 @@ export default function App() {
                 <div className="mb-3 text-center">
                   <small className="text-muted d-block mb-1">All masks (combined)</small>
                   <img
-                    src={`data:image/png;base64,${combinedThumb}`}
+                    src={`data:image/jpeg;base64,${combinedThumb}`}
                     alt="Combined masks"
                     className="border"
                     style={{ maxWidth: "600px", width: "100%" }}